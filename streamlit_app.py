@@ -1,322 +1,652 @@
 import streamlit as st
 import os
-import json
-import datetime
-import requests
-from dotenv import load_dotenv
-from openai import OpenAI
-import wikipedia
+import asyncio
+import orjson
+import hashlib
+import itertools
+import queue
 import re
-from bs4 import BeautifulSoup
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal, Optional
+from dotenv import load_dotenv
+import httpx
+import numpy as np
+from openai import AsyncOpenAI
+from pydantic import BaseModel, ValidationError, model_validator
 
-# Import your StudyBuddyDB class and tools
-from study_buddy_agent import StudyBuddyDB, available_tools
+# Import the database and tools. The tools write through the agent module's
+# db, so the app shares that instance (and its connection pool) too.
+from study_buddy_agent import db, TOOL_FNS, TOOL_DESCRIPTIONS, partial_step_content
 
 # Load environment variables
 load_dotenv()
 
-# Initialize the database
-db = StudyBuddyDB()
+def refresh_study_state():
+    """Load the user's plan and progress into the session.
+
+    The sidebar reads only from the session, so the database is queried once
+    per login and after each tool call that changes the data, not on every rerun.
+    """
+    user_id = db.get_or_create_user(st.session_state.username)
+    st.session_state.user_id = user_id
+    plan = db.get_current_study_plan(user_id)
+    st.session_state.plan = plan
+    st.session_state.progress = db.get_progress(user_id)
+    st.session_state.next_incomplete_topic = next(
+        (topic["topic"] for topic in plan["study_plan"] if not topic["completed"]), None
+    ) if plan else None
+
+# Tools that write to the database; conversations using them are never cached,
+# and running one empties the session's tool cache
+MUTATING_TOOLS = frozenset({"create_study_plan", "check_quiz_answer", "mark_topic_complete", "generate_quiz"})
+
+# Tools whose output can change between calls with the same input; answer_question
+# falls back to text built from the current plan's subject
+UNCACHEABLE_TOOLS = MUTATING_TOOLS | {"track_progress", "answer_question"}
+
+# Read-only tool outputs kept per session
+MAX_TOOL_CACHE_ENTRIES = 64
+
+# Words that only frame a question ("what is", "explain") and don't change what is asked.
+# Negations, numbers and single letters such as the "I" in "World War I" are kept.
+_QUERY_STOPWORDS = frozenset("""
+a an the is are was be it this that me my you your please tell explain describe define
+what whats how why can could would do does about give
+""".split())
+_WORD_RE = re.compile(r"[a-z0-9]+")
+EMBED_DIM = 1024
+
+# Minimum cosine similarity for a rephrased query to reuse a cached answer
+SEMANTIC_CACHE_THRESHOLD = 0.85
+
+def query_terms(query):
+    """Content words of a query, in the order they were written"""
+    return [word for word in _WORD_RE.findall(query.lower()) if word not in _QUERY_STOPWORDS]
+
+def embed_query(terms):
+    """Hashed vector of a query's content words and adjacent word pairs, L2-normalised.
+
+    The word pairs make the vector depend on word order, so "celsius to
+    fahrenheit" and "fahrenheit to celsius" stay apart.
+    """
+    vector = np.zeros(EMBED_DIM, dtype=np.float32)
+    for feature in itertools.chain(terms, map(" ".join, zip(terms, terms[1:]))):
+        vector[int(hashlib.blake2b(feature.encode(), digest_size=4).hexdigest(), 16) % EMBED_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class ResponseCache:
+    """Thread-safe LRU cache with expiry, for finished conversations and tool outputs.
+
+    Entries stored with a scope, term set and query vector can also be found by
+    cosine similarity, among entries with the same scope and the same content words.
+    """
+    def __init__(self, max_entries=512, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value, _ = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def get_similar(self, scope, terms, vector, threshold):
+        """Return the value of the most similar live entry for the same scope and terms, if close enough"""
+        match_on = (scope, frozenset(terms))
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if entry[2] is not None and entry[2][0] == match_on and now - entry[0] <= self.ttl
+            ]
+            if not candidates:
+                return None
+            similarities = np.stack([entry[2][1] for _, entry in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                return None
+            key, entry = candidates[best]
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, scope=None, terms=None, vector=None):
+        with self._lock:
+            index = ((scope, frozenset(terms)), vector) if vector is not None else None
+            self._entries[key] = (time.monotonic(), value, index)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def get_response_cache():
+    """Response cache shared by all sessions of this server process"""
+    return ResponseCache()
+
+class ToolCall(BaseModel):
+    """A single tool invocation inside an action step"""
+    function: str
+    input: Optional[str] = None
+
+class Step(BaseModel):
+    """One step of the plan/action/observe/output protocol the model replies with"""
+    step: Literal["plan", "action", "observe", "output"]
+    content: Optional[str] = None
+    function: Optional[str] = None
+    input: Optional[str] = None
+    calls: Optional[List[ToolCall]] = None
 
-# System prompt (updated to provide more detailed, comprehensive responses)
+    @model_validator(mode="after")
+    def _action_names_a_tool(self):
+        # Rejected here so the reply goes through the invalid-reply retry
+        if self.step == "action" and not self.function and not self.calls:
+            raise ValueError("an action step needs a function or calls")
+        return self
+
+# Number of recent steps, each with its observation or retry prompt, re-sent to the model on every call
+HISTORY_WINDOW = 4
+
+# Chat messages kept per session, and how many of the newest are drawn on each rerun
+MAX_CHAT_MESSAGES = 200
+RENDERED_CHAT_MESSAGES = 50
+
+# Longest tool output re-sent to the model; the UI still shows the full text
+MAX_OBSERVATION_CHARS = 4000
+
+# Minimum time between placeholder redraws while a response streams in
+STREAM_FLUSH_INTERVAL = 0.05
+
+# Worker threads for tool calls, shared by all sessions
+_TOOL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool")
+
+# One long-lived event loop runs every agent conversation while the script thread
+# renders it. Async clients are bound to the loop they first ran on, so sharing
+# the loop is what lets a cached client keep its connections between queries.
+@st.cache_resource
+def get_agent_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True).start()
+    return loop
+
+def _new_llm_client(api_key, base_url):
+    """Async client with its own keep-alive HTTP/2 connection pool"""
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=300.0),
+        timeout=30.0
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client
+    )
+
+class LLMClientPool:
+    """One client per (API key, base URL), reused across queries, reruns and sessions.
+
+    Every request goes over an already-open keep-alive HTTP/2 connection to Groq.
+    A client that is dropped (its key was replaced, or it fell out of the
+    max_clients least recently used) is closed on the agent loop as soon as no
+    running conversation still uses it, so old keys don't leave pools open.
+    """
+    def __init__(self, loop, max_clients=8):
+        self.loop = loop
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._in_use = {}
+        self._dropped = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, api_key, base_url):
+        """Return the client for this key, held until release() is called"""
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = _new_llm_client(api_key, base_url)
+            self._clients.move_to_end(key)
+            self._in_use[client] = self._in_use.get(client, 0) + 1
+            while len(self._clients) > self.max_clients:
+                self._drop(self._clients.popitem(last=False)[1])
+            return client
+
+    def release(self, client):
+        with self._lock:
+            self._in_use[client] -= 1
+            if not self._in_use[client]:
+                del self._in_use[client]
+                if client in self._dropped:
+                    self._close(client)
+
+    def discard(self, api_key, base_url):
+        """Stop handing out the client for this key and close it once it is idle"""
+        with self._lock:
+            client = self._clients.pop((api_key, base_url), None)
+            if client is not None:
+                self._drop(client)
+
+    def _drop(self, client):
+        if client in self._in_use:
+            self._dropped.add(client)
+        else:
+            self._close(client)
+
+    def _close(self, client):
+        self._dropped.discard(client)
+        asyncio.run_coroutine_threadsafe(client.close(), self.loop)
+
+@st.cache_resource
+def get_llm_clients():
+    return LLMClientPool(get_agent_loop())
+
+# System prompt (updated to provide more detailed, comprehensive responses).
+# The tool list is generated from available_tools so it is only written once.
 system_prompt = """
 You are Study Buddy AI, a helpful AI assistant specialized in helping students learn effectively.
-You work on start, plan, action, observe mode.
-
-For the given user query and available tools, plan the step by step execution.
-Based on the planning, select the relevant tool from the available tools.
-And based on the tool selection you perform an action to call the tool.
-Wait for the observation and based on the observation from the tool call, resolve the user query.
+You work in plan, action, observe mode: plan the steps for the user query, call one of the
+available tools as an action, wait for the observation, then resolve the user query.
 
 When interacting with users:
 1. Maintain a friendly, encouraging tone with vibrant personality
-2. Focus on making learning personal and exciting
-3. Provide DETAILED and COMPREHENSIVE explanations - never be brief unless specifically asked
-4. Include examples, analogies, and multiple perspectives when explaining concepts
-5. Break down complex topics into digestible parts with thorough explanations
-6. When teaching a topic, cover it in depth with proper structure (introduction, main concepts, examples, applications)
+2. Provide DETAILED and COMPREHENSIVE explanations - never be brief unless specifically asked
+3. Include examples, analogies, and multiple perspectives when explaining concepts
+4. Cover topics in depth with proper structure (introduction, main concepts, examples, applications)
 
 Rules:
-1. Follow the strict json output as per output schema 
-2. Always perform one step at a time and wait for next input
-3. Carefully analyze the user query and determine which educational goal they're trying to achieve
-4. Be encouraging and motivational in your final responses
-5. Suggest next steps for the student based on their progress
-6. Provide thorough, comprehensive answers - aim to teach the topic completely
-
-Output JSON format: 
-{
-    "step":"string",
-    "content": "string",
-    "function": "the name of the function if the step is the action",
-    "input": "The input parameter for the function"
-}
+1. Reply with one JSON step at a time and wait for the next input
+2. Carefully analyze which educational goal the user is trying to achieve
+3. Be encouraging in your final response and suggest next steps based on their progress
+
+Output JSON format: {"step": "plan|action|output", "content": "string", "function": "tool name (action only)", "input": "tool input (action only)"}
+To run several independent tools at once, send one action step with "calls": [{"function": "tool name", "input": "tool input"}, ...]
 
 Available Tools:
-- create_study_plan: Creates a personalized study plan based on subject and timeline. Input format: "Subject: Math, Goal: Master Algebra in 2 weeks"
-- answer_question: Answers a subject-specific question. Input format: "What's 2x + 3 = 7?"
-- generate_quiz: Generates a quiz on a specific topic. Input format: "Linear Equations"
-- check_quiz_answer: Checks a quiz answer against the correct answer. Input format: "Question: Solve for x: 3x + 5 = 14, Answer: x = 3"
-- track_progress: Updates and reports on the user's learning progress. Input can be a specific topic or empty for overall progress.
-- retrieve_learning_material: Retrieves learning materials for a specific topic. Input format: "Linear Equations"
-- mark_topic_complete: Marks a topic as completed in the study plan. Input format: "Linear Equations"
-- search_wikipedia: Searches Wikipedia for up-to-date information on a topic. Input format: "Albert Einstein"
-- search_web: Searches the web for recent information on a topic. Input format: "latest developments in quantum computing"
-- fetch_academic_resources: Fetches academic resources and papers on a subject. Input format: "deep learning"
-"""
-
-# New tools for accessing live information
-def search_wikipedia(query, username="default_user"):
-    """
-    Searches Wikipedia for information on a specific topic.
-    Input format: "Albert Einstein"
-    """
-    try:
-        # Search Wikipedia
-        search_results = wikipedia.search(query, results=3)
-        
-        if not search_results:
-            return f"No Wikipedia results found for '{query}'."
-        
-        # Get the page for the first result
-        try:
-            page = wikipedia.page(search_results[0], auto_suggest=False)
-        except wikipedia.DisambiguationError as e:
-            # If disambiguation page, take the first option
-            page = wikipedia.page(e.options[0], auto_suggest=False)
-        
-        # Get summary and sections
-        summary = page.summary
-        content = f"# {page.title}\n\n{summary}\n\n"
-        
-        # Add a few sections if available
-        if len(page.sections) > 0:
-            for section in page.sections[:3]:  # Limit to first 3 sections
-                try:
-                    section_content = page.section(section)
-                    if section_content and len(section_content) > 10:  # Only add non-empty sections
-                        content += f"## {section}\n\n{section_content}\n\n"
-                except:
-                    pass
-        
-        # Add reference
-        content += f"\nSource: Wikipedia, Retrieved on {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        content += f"\nURL: {page.url}"
-        
-        return content
-        
-    except Exception as e:
-        return f"Error searching Wikipedia: {str(e)}"
+""" + TOOL_DESCRIPTIONS
 
-def search_web(query, username="default_user"):
-    """
-    Searches the web for recent information on a topic.
-    Input format: "latest developments in quantum computing"
-    """
-    try:
-        # Use a search API (simplified for example)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # Try to get some educational content from Khan Academy
-        url = f"https://www.khanacademy.org/search?page_search_query={query.replace(' ', '+')}"
-        response = requests.get(url, headers=headers)
-        
-        content = f"# Web search results for: {query}\n\n"
-        
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Try to find search results
-            results = soup.find_all('a', class_=re.compile('result'))
-            
-            if results:
-                content += "## Khan Academy Resources:\n\n"
-                for idx, result in enumerate(results[:5]):  # Limit to 5 results
-                    title = result.get_text(strip=True)
-                    link = "https://www.khanacademy.org" + result['href'] if result.has_attr('href') else ""
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-            
-        # Also try to find resources from Coursera
-        url = f"https://www.coursera.org/search?query={query.replace(' ', '%20')}"
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Try to find course cards
-            results = soup.find_all('div', class_=re.compile('card'))
-            
-            if results:
-                content += "\n## Coursera Courses:\n\n"
-                for idx, result in enumerate(results[:5]):  # Limit to 5 results
-                    title_elem = result.find('h2') or result.find('h3')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-                    
-                    link_elem = result.find('a')
-                    link = "https://www.coursera.org" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-                    
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-        
-        content += f"\nSearch performed on: {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        return content
-        
-    except Exception as e:
-        return f"Error searching the web: {str(e)}"
+# Shared by every conversation; the OpenAI client never mutates messages
+SYSTEM_MSG = {"role": "system", "content": system_prompt}
 
-def fetch_academic_resources(subject, username="default_user"):
-    """
-    Fetches academic resources and papers on a subject.
-    Input format: "deep learning"
-    """
-    try:
-        content = f"# Academic Resources for: {subject}\n\n"
-        
-        # Try to get resources from arXiv
-        url = f"https://arxiv.org/search/?query={subject.replace(' ', '+')}&searchtype=all"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Find paper entries
-            entries = soup.find_all('li', class_='arxiv-result')
-            
-            if entries:
-                content += "## Recent arXiv Papers:\n\n"
-                for idx, entry in enumerate(entries[:5]):  # Limit to 5 papers
-                    title_elem = entry.find('p', class_='title')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-                    
-                    authors_elem = entry.find('p', class_='authors')
-                    authors = authors_elem.get_text(strip=True) if authors_elem else ""
-                    
-                    abstract_elem = entry.find('span', class_='abstract-full')
-                    abstract = abstract_elem.get_text(strip=True) if abstract_elem else ""
-                    
-                    link_elem = entry.find('a', class_='abstract-full')
-                    link = "https://arxiv.org" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-                    
-                    if title:
-                        content += f"### {idx+1}. {title}\n"
-                        if authors:
-                            content += f"**Authors:** {authors}\n\n"
-                        if abstract:
-                            content += f"**Abstract:** {abstract[:300]}...\n\n"
-                        if link:
-                            content += f"[Read more]({link})\n\n"
-        
-        # Add MIT OpenCourseWare
-        url = f"https://ocw.mit.edu/search/?q={subject.replace(' ', '+')}"
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Find course entries
-            entries = soup.find_all('div', class_=re.compile('course-card'))
-            
-            if entries:
-                content += "## MIT OpenCourseWare:\n\n"
-                for idx, entry in enumerate(entries[:5]):  # Limit to 5 courses
-                    title_elem = entry.find('h2') or entry.find('h3')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-                    
-                    link_elem = entry.find('a')
-                    link = "https://ocw.mit.edu" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-                    
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-        
-        content += f"\nResources retrieved on: {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        return content
-        
-    except Exception as e:
-        return f"Error fetching academic resources: {str(e)}"
-
-# Add new tools to available_tools dictionary
-available_tools.update({
-    "search_wikipedia": {
-        "fn": search_wikipedia,
-        "description": "Searches Wikipedia for information on a specific topic. Input format: 'Albert Einstein'"
-    },
-    "search_web": {
-        "fn": search_web,
-        "description": "Searches the web for recent information on a topic. Input format: 'latest developments in quantum computing'"
-    },
-    "fetch_academic_resources": {
-        "fn": fetch_academic_resources,
-        "description": "Fetches academic resources and papers on a subject. Input format: 'deep learning'"
-    }
-})
+# Sent back when a reply isn't a valid step, at most MAX_INVALID_REPLIES times per query
+INVALID_JSON_MSG = {"role": "user", "content": "Your previous response was not valid JSON. Repeat it in the specified format."}
+MAX_INVALID_REPLIES = 2
+
+def _clip_observation(output):
+    """Cut a tool output down to MAX_OBSERVATION_CHARS before it goes into the prompt"""
+    if not isinstance(output, str) or len(output) <= MAX_OBSERVATION_CHARS:
+        return output
+    return output[:MAX_OBSERVATION_CHARS] + "\n[...truncated]"
 
-def run_conversation(query, username, api_key, base_url):
-    """Run the conversation with the LLM and execute tools"""
+async def _run_tool(tool_name, tool_input, username, tool_cache=None):
+    """Run one tool call, reusing a cached output for read-only tools"""
+    fn = TOOL_FNS.get(tool_name)
+    if fn is None:
+        return f"Tool '{tool_name}' not found"
     
-    # Initialize client with user's API key
-    client = OpenAI(
-        api_key=api_key,
-        base_url=base_url
-    )
+    cache_key = (username, tool_name, tool_input)
+    if tool_cache is not None and tool_name not in UNCACHEABLE_TOOLS:
+        cached = tool_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    # Pass username to functions, running the (blocking) tool and its
+    # DB writes on the shared tool pool so they don't stall the event loop
+    output = await asyncio.get_running_loop().run_in_executor(_TOOL_POOL, fn, tool_input, username)
+    if tool_cache is not None:
+        if tool_name in MUTATING_TOOLS:
+            # Cached outputs may describe the data this tool just changed
+            tool_cache.clear()
+        elif tool_name not in UNCACHEABLE_TOOLS:
+            tool_cache.set(cache_key, output)
+    return output
+
+async def run_conversation_async(query, username, client, updates=None, tool_cache=None):
+    """Run the conversation with the LLM and execute tools.
+
+    If an updates queue is given, every streamed delta is put on it, with None
+    marking the start of a new step, so a renderer can display tokens as they
+    arrive without blocking the stream. Outputs of read-only tools are stored
+    in tool_cache (a ResponseCache, if given) and reused for repeated calls.
+    """
     
-    # Initialize messages list
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": query}
-    ]
+    # The system prompt and user query open every request; each turn after them is
+    # one reply plus whatever answered it (an observation or a retry prompt)
+    head = [SYSTEM_MSG, {"role": "user", "content": query}]
+    turns = deque(maxlen=HISTORY_WINDOW)
     
     conversation_steps = []
+    tools_used = []
     final_output = None
+    invalid_replies = 0
     
     while True:
         try:
-            # Get response from LLM
-            response = client.chat.completions.create(
+            # Keep the system prompt, the user query and only the most recent whole turns,
+            # so an action is never sent without its observation or the other way round
+            messages = head + [message for turn in turns for message in turn]
+        
+            # Stream response from LLM so the UI can render tokens as they arrive
+            stream = await client.chat.completions.create(
                 model="meta-llama/llama-4-maverick-17b-128e-instruct",
                 response_format={"type":"json_object"},
-                messages=messages
+                messages=messages,
+                stream=True
             )
-            
-            parsed_response = json.loads(response.choices[0].message.content)
-            messages.append({"role": "assistant", "content": json.dumps(parsed_response)})
-            
-            if parsed_response.get("step") == "plan":
-                conversation_steps.append(("plan", parsed_response.get("content")))
+        
+            # Collect chunks in a list and only try to parse once the stream looks
+            # complete (ends in "}"), keeping parse work linear in output size
+            chunks = []
+            parsed_response = None
+            if updates is not None:
+                updates.put(None)
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                chunks.append(delta)
+                if updates is not None:
+                    updates.put(delta)
+                if parsed_response is None and delta.rstrip()[-1:] == "}":
+                    try:
+                        parsed_response = Step.model_validate_json("".join(chunks))
+                    except ValueError:
+                        pass  # Closed a nested object, keep streaming
+        
+            raw_response = "".join(chunks)
+            if parsed_response is None:
+                try:
+                    parsed_response = Step.model_validate_json(raw_response)
+                except ValidationError:
+                    # One malformed reply shouldn't end the session - ask for a corrected one
+                    if invalid_replies >= MAX_INVALID_REPLIES:
+                        raise
+                    invalid_replies += 1
+                    turns.append([{"role": "assistant", "content": raw_response}, INVALID_JSON_MSG])
+                    continue
+            # The model already sent valid JSON, so keep its text rather than re-serialising
+            reply = {"role": "assistant", "content": raw_response}
+        
+            if parsed_response.step == "plan":
+                conversation_steps.append(("plan", parsed_response.content))
+                turns.append([reply])
                 continue
+            
+            if parsed_response.step == "action":
+                calls = parsed_response.calls or [
+                    ToolCall(function=parsed_response.function, input=parsed_response.input)
+                ]
+                for call in calls:
+                    conversation_steps.append(("action", f"Using {call.function} with input: {call.input}"))
+                    tools_used.append(call.function)
                 
-            if parsed_response.get("step") == "action":
-                tool_name = parsed_response.get("function")
-                tool_input = parsed_response.get("input")
+                # Independent calls from one action step run concurrently
+                outputs = await asyncio.gather(*(
+                    _run_tool(call.function, call.input, username, tool_cache) for call in calls
+                ))
                 
-                conversation_steps.append(("action", f"Using {tool_name} with input: {tool_input}"))
-
-                if tool_name in available_tools:
-                    # Pass username to functions
-                    output = available_tools[tool_name].get("fn")(tool_input, username)
-                    messages.append({"role":"assistant","content": json.dumps({"step": "observe", "output": output})})
-                    conversation_steps.append(("observe", output))
-                    continue
+                # Long scraped pages would otherwise be prefilled again on every later step
+                model_outputs = [_clip_observation(output) for output in outputs]
+                if len(calls) == 1:
+                    observation = {"step": "observe", "output": model_outputs[0]}
                 else:
-                    messages.append({"role":"assistant","content": json.dumps({"step": "observe", "output": f"Tool '{tool_name}' not found"})})
-                    conversation_steps.append(("observe", f"Tool '{tool_name}' not found"))
-                    continue
-                    
-            if parsed_response.get("step") == "output":
-                final_output = parsed_response.get("content")
-                break
+                    observation = {"step": "observe", "outputs": [
+                        {"function": call.function, "output": output} for call, output in zip(calls, model_outputs)
+                    ]}
+                turns.append([reply, {"role":"assistant","content": orjson.dumps(observation).decode()}])
+                for output in outputs:
+                    conversation_steps.append(("observe", output))
+                continue
                 
+            if parsed_response.step == "output":
+                final_output = parsed_response.content
+                break
+            
+            # An observe step written by the model itself; keep it so the model sees it said so
+            turns.append([reply])
+            
         except Exception as e:
             final_output = f"An error occurred: {e}"
             break
-            
+    
+    return conversation_steps, final_output, tools_used
+
+def _state_fingerprint():
+    """Hash of the user's study plan so cached answers expire when it changes"""
+    # The session copy is refreshed after every mutating tool, so no query is needed
+    plan = st.session_state.plan
+    return hashlib.sha256(orjson.dumps(plan, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _render_stream(updates, future, placeholder, chunks):
+    """Draw streamed deltas from the agent thread until the conversation finishes.
+
+    The queue is drained in batches and the placeholder is redrawn at most every
+    STREAM_FLUSH_INTERVAL, however fast tokens arrive. Deltas of the current step
+    are kept in chunks, so a resumed render can redraw the text seen so far.
+    """
+    changed = bool(chunks)
+    while True:
+        done = future.done()
+        try:
+            while True:
+                delta = updates.get_nowait()
+                if delta is None:
+                    chunks.clear()  # A new step started
+                else:
+                    chunks.append(delta)
+                changed = True
+        except queue.Empty:
+            pass
+        
+        if changed:
+            partial = partial_step_content("".join(chunks))
+            if partial:
+                placeholder.markdown(partial)
+            changed = False
+        if done:
+            return
+        time.sleep(STREAM_FLUSH_INTERVAL)
+
+def run_conversation(query, username, api_key, base_url, placeholder=None):
+    """Synchronous entry point for the Streamlit script.
+
+    Finished conversations are cached on (username, query, study plan state), so
+    repeated queries such as the "Check Progress" quick action skip the LLM.
+    Rephrasings of a cached query ("what is photosynthesis" / "explain
+    photosynthesis") are matched by query-vector similarity, but only when both
+    use exactly the same content words, since questions that differ in one word
+    or number need different answers.
+    """
+    cache = get_response_cache()
+    scope = (username, _state_fingerprint())
+    key = (username, " ".join(query.lower().split()), scope[1])
+    cached = cache.get(key)
+    terms = query_terms(query)
+    vector = embed_query(terms) if terms else None
+    if cached is None and vector is not None:
+        cached = cache.get_similar(scope, terms, vector, SEMANTIC_CACHE_THRESHOLD)
+    if cached is not None:
+        _record_answer(*cached)
+        return cached
+    
+    # The agent loop runs on its own thread and hands tokens over through a queue,
+    # so decoding the stream never waits on Streamlit rendering
+    updates = queue.Queue()
+    clients = get_llm_clients()
+    client = clients.acquire(api_key, base_url)
+    future = asyncio.run_coroutine_threadsafe(
+        run_conversation_async(query, username, client, updates, st.session_state.tool_cache),
+        get_agent_loop()
+    )
+    future.add_done_callback(lambda _: clients.release(client))
+    st.session_state.active_conversation = {
+        "future": future, "updates": updates, "chunks": [], "key": key,
+        "scope": scope, "terms": terms, "vector": vector
+    }
+    return finish_conversation(placeholder)
+
+def finish_conversation(placeholder=None):
+    """Wait for the active conversation, streaming it into placeholder, and return its answer.
+
+    The conversation stays in session state until its answer is in the chat
+    history, so when a rerun (e.g. a sidebar click) stops the script mid-stream,
+    the next run resumes rendering the same answer instead of losing it.
+    """
+    active = st.session_state.active_conversation
+    if placeholder is not None:
+        _render_stream(active["updates"], active["future"], placeholder, active["chunks"])
+    conversation_steps, final_output, tools_used = active["future"].result()
+    
+    # Reruns only stop the script at Streamlit calls, so with none between these
+    # lines the answer is never lost or recorded twice
+    if MUTATING_TOOLS.intersection(tools_used):
+        refresh_study_state()
+    _record_answer(conversation_steps, final_output)
+    del st.session_state.active_conversation
+    
+    # Don't replay conversations that changed data or failed
+    if final_output and not final_output.startswith("An error occurred") and not MUTATING_TOOLS.intersection(tools_used):
+        get_response_cache().set(
+            active["key"], (conversation_steps, final_output), active["scope"], active["terms"], active["vector"]
+        )
     return conversation_steps, final_output
 
+def _record_answer(conversation_steps, final_output):
+    """Add an assistant answer to the chat history"""
+    st.session_state.conversation_history.append(
+        {"role": "assistant", "content": final_output, "steps": conversation_steps}
+    )
+
+def render_answer(placeholder, conversation_steps, final_output):
+    """Show a finished answer in its placeholder, with its steps if they're switched on"""
+    placeholder.markdown(final_output)
+    if st.session_state.show_steps:
+        render_steps(conversation_steps)
+
+def render_message(message):
+    """Draw one chat history entry, with its execution steps if they're switched on"""
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        if st.session_state.show_steps and message.get("steps"):
+            render_steps(message["steps"])
+
+def render_steps(conversation_steps):
+    """Show the plan/action/observe steps behind an answer"""
+    with st.expander("View execution steps"):
+        for step_type, step_content in conversation_steps:
+            if step_type == "plan":
+                st.info(f"🧠 Planning: {step_content}")
+            elif step_type == "action":
+                st.warning(f"⚙️ Action: {step_content}")
+            elif step_type == "observe":
+                st.success(f"👁️ Observation: {step_content}")
+
+@st.fragment
+def render_sidebar():
+    """Sidebar with the study plan and quick actions.
+
+    Runs as a fragment so its own widgets (e.g. the research topic box) only
+    rerun the sidebar. Buttons that change the chat rerun the whole app.
+    """
+    st.header(f"Hello, {st.session_state.username}! 👋")
+    
+    # Display current study plan if available
+    plan = st.session_state.plan
+    
+    if plan:
+        st.subheader("Your Current Study Plan")
+        st.write(f"Subject: {plan['subject']}")
+        st.write(f"Goal: {plan['goal']}")
+        
+        progress_data = st.session_state.progress
+        if progress_data:
+            st.progress(progress_data['overall_progress'] / 100)
+            st.write(f"Overall Progress: {progress_data['overall_progress']}%")
+        
+        st.subheader("Topics")
+        # One markdown element for the whole list instead of one widget per topic
+        st.markdown("\n".join(
+            f"- :green[✓ Day {topic['day']}: {topic['topic']} ({topic['progress']}%)]" if topic['completed']
+            else f"- □ Day {topic['day']}: {topic['topic']} ({topic['progress']}%)"
+            for topic in plan['study_plan']
+        ))
+    
+    # Quick actions
+    st.subheader("Quick Actions")
+    if st.button("Create Study Plan"):
+        st.session_state.pending_query = "I want to create a new study plan"
+        st.rerun()  # Updated from experimental_rerun()
+    
+    if st.button("Check Progress"):
+        st.session_state.pending_query = "How is my progress?"
+        st.rerun()  # Updated from experimental_rerun()
+    
+    if st.button("Generate Quiz"):
+        if plan and plan['study_plan']:
+            # The first incomplete topic is precomputed whenever the plan is loaded
+            topic = st.session_state.next_incomplete_topic
+            if topic:
+                # generate_quiz is a local tool, so call it directly instead of
+                # going through the LLM, and keep the result for repeat clicks
+                quiz_cache = st.session_state.quiz_cache
+                if topic not in quiz_cache:
+                    quiz_cache[topic] = TOOL_FNS["generate_quiz"](topic, st.session_state.username)
+                st.session_state.conversation_history.append({"role": "user", "content": f"Generate a quiz on {topic}"})
+                st.session_state.conversation_history.append({"role": "assistant", "content": quiz_cache[topic]})
+                st.rerun()  # Updated from experimental_rerun()
+        else:
+            st.warning("Create a study plan first to generate quizzes")
+    
+    st.subheader("Research Tools")
+    research_topic = st.text_input("Research Topic:")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Search Wikipedia"):
+            if research_topic:
+                st.session_state.pending_query = f"Search Wikipedia for: {research_topic}"
+                st.rerun()  # Updated from experimental_rerun()
+            else:
+                st.warning("Please enter a topic")
+    with col2:
+        if st.button("Find Resources"):
+            if research_topic:
+                st.session_state.pending_query = f"Find academic resources on: {research_topic}"
+                st.rerun()  # Updated from experimental_rerun()
+            else:
+                st.warning("Please enter a topic")
+    
+    if st.button("Clear Conversation"):
+        st.session_state.conversation_history.clear()
+        st.session_state.conversation_history.append(
+            {"role": "assistant", "content": f"Welcome back, {st.session_state.username}! What would you like to study?"}
+        )
+        st.rerun()  # Updated from experimental_rerun()
+    
+    # API key management
+    st.subheader("Settings")
+    with st.expander("API Settings"):
+        new_api_key = st.text_input("Update API Key:", type="password")
+        if st.button("Update"):
+            if new_api_key:
+                # The old key's client would otherwise keep its connections open
+                get_llm_clients().discard(st.session_state.api_key, st.session_state.base_url)
+                st.session_state.api_key = new_api_key
+                st.success("API key updated!")
+                st.rerun()  # Updated from experimental_rerun()
+
 # Streamlit app
 st.set_page_config(
     page_title="Study Buddy AI",
@@ -333,9 +663,13 @@ if "username" not in st.session_state:
 if "api_key" not in st.session_state:
     st.session_state.api_key = ""
 if "conversation_history" not in st.session_state:
-    st.session_state.conversation_history = []
+    st.session_state.conversation_history = deque(maxlen=MAX_CHAT_MESSAGES)
 if "show_steps" not in st.session_state:
     st.session_state.show_steps = False
+if "quiz_cache" not in st.session_state:
+    st.session_state.quiz_cache = {}
+if "tool_cache" not in st.session_state:
+    st.session_state.tool_cache = ResponseCache(max_entries=MAX_TOOL_CACHE_ENTRIES)
 
 # API key and username setup
 if not st.session_state.username or not st.session_state.api_key:
@@ -358,129 +692,58 @@ if not st.session_state.username or not st.session_state.api_key:
                 st.session_state.username = username
                 st.session_state.api_key = api_key
                 st.session_state.base_url = base_url
-                st.session_state.conversation_history.append(f"🤖 Welcome, {username}! What would you like to study?")
+                st.session_state.conversation_history.append(
+                    {"role": "assistant", "content": f"Welcome, {username}! What would you like to study?"}
+                )
                 st.rerun()  # Updated from experimental_rerun()
 
 # Main conversation area
 if st.session_state.username and st.session_state.api_key:
-    # Display conversation history
-    for message in st.session_state.conversation_history:
-        st.write(message)
+    if "user_id" not in st.session_state:
+        refresh_study_state()
+    
+    st.toggle("Show execution steps", key="show_steps")
+    
+    # Display conversation history; older messages are only drawn on request
+    history = st.session_state.conversation_history
+    older = max(len(history) - RENDERED_CHAT_MESSAGES, 0)
+    if older and not st.toggle("Show older messages", key="show_older"):
+        history = itertools.islice(history, older, None)
+    for message in history:
+        render_message(message)
     
-    # Input for new query
-    with st.form("query_form"):
-        query = st.text_input("What would you like to learn about?", key="query_input")
-        col1, col2, col3 = st.columns([1, 1, 5])
-        with col1:
-            submit_button = st.form_submit_button("Send")
-        with col2:
-            toggle_steps = st.form_submit_button("Toggle Steps")
-            if toggle_steps:
-                st.session_state.show_steps = not st.session_state.show_steps
+    # Input for new query; quick actions in the sidebar queue one up as well
+    query = st.chat_input("What would you like to learn about?")
+    
+    if "active_conversation" in st.session_state:
+        # A rerun (a sidebar click or a new query) cut the previous answer off
+        # mid-stream. It kept running, so finish it before starting another one,
+        # holding a new query back in case this run is interrupted too.
+        if query:
+            st.session_state.pending_query = query
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            render_answer(placeholder, *finish_conversation(placeholder))
+        query = None
+    
+    query = query or st.session_state.pop("pending_query", None)
+    
+    if query:
+        st.session_state.conversation_history.append({"role": "user", "content": query})
+        with st.chat_message("user"):
+            st.markdown(query)
         
-        if submit_button and query:
-            st.session_state.conversation_history.append(f"👤 {query}")
-            
-            # Process the query
-            conversation_steps, final_output = run_conversation(
+        with st.chat_message("assistant"):
+            # Process the query, streaming each step into a placeholder as it arrives
+            placeholder = st.empty()
+            render_answer(placeholder, *run_conversation(
                 query, 
                 st.session_state.username, 
                 st.session_state.api_key,
-                st.session_state.base_url
-            )
-            
-            # Display step-by-step execution if toggled on
-            if st.session_state.show_steps:
-                step_expander = st.expander("View execution steps", expanded=True)
-                with step_expander:
-                    for step_type, step_content in conversation_steps:
-                        if step_type == "plan":
-                            st.info(f"🧠 Planning: {step_content}")
-                        elif step_type == "action":
-                            st.warning(f"⚙️ Action: {step_content}")
-                        elif step_type == "observe":
-                            st.success(f"👁️ Observation: {step_content}")
-            
-            # Display final output
-            st.session_state.conversation_history.append(f"📚 {final_output}")
-            
-            # Clear the input
-            st.rerun()  # Updated from experimental_rerun()
+                st.session_state.base_url,
+                placeholder
+            ))
     
     # Sidebar with additional options
     with st.sidebar:
-        st.header(f"Hello, {st.session_state.username}! 👋")
-        
-        # Display current study plan if available
-        user_id = db.get_or_create_user(st.session_state.username)
-        plan = db.get_current_study_plan(user_id)
-        
-        if plan:
-            st.subheader("Your Current Study Plan")
-            st.write(f"Subject: {plan['subject']}")
-            st.write(f"Goal: {plan['goal']}")
-            
-            progress_data = db.get_progress(user_id)
-            if progress_data:
-                st.progress(progress_data['overall_progress'] / 100)
-                st.write(f"Overall Progress: {progress_data['overall_progress']}%")
-            
-            st.subheader("Topics")
-            for topic in plan['study_plan']:
-                if topic['completed']:
-                    st.success(f"✓ Day {topic['day']}: {topic['topic']} ({topic['progress']}%)")
-                else:
-                    st.write(f"□ Day {topic['day']}: {topic['topic']} ({topic['progress']}%)")
-        
-        # Quick actions
-        st.subheader("Quick Actions")
-        if st.button("Create Study Plan"):
-            st.session_state.conversation_history.append("👤 I want to create a new study plan")
-            st.rerun()  # Updated from experimental_rerun()
-        
-        if st.button("Check Progress"):
-            st.session_state.conversation_history.append("👤 How is my progress?")
-            st.rerun()  # Updated from experimental_rerun()
-        
-        if st.button("Generate Quiz"):
-            if plan and plan['study_plan']:
-                # Get the first incomplete topic
-                for topic in plan['study_plan']:
-                    if not topic['completed']:
-                        st.session_state.conversation_history.append(f"👤 Generate a quiz on {topic['topic']}")
-                        st.rerun()  # Updated from experimental_rerun()
-                        break
-            else:
-                st.warning("Create a study plan first to generate quizzes")
-        
-        st.subheader("Research Tools")
-        research_topic = st.text_input("Research Topic:")
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("Search Wikipedia"):
-                if research_topic:
-                    st.session_state.conversation_history.append(f"👤 Search Wikipedia for: {research_topic}")
-                    st.rerun()  # Updated from experimental_rerun()
-                else:
-                    st.warning("Please enter a topic")
-        with col2:
-            if st.button("Find Resources"):
-                if research_topic:
-                    st.session_state.conversation_history.append(f"👤 Find academic resources on: {research_topic}")
-                    st.rerun()  # Updated from experimental_rerun()
-                else:
-                    st.warning("Please enter a topic")
-        
-        if st.button("Clear Conversation"):
-            st.session_state.conversation_history = [f"🤖 Welcome back, {st.session_state.username}! What would you like to study?"]
-            st.rerun()  # Updated from experimental_rerun()
-        
-        # API key management
-        st.subheader("Settings")
-        with st.expander("API Settings"):
-            new_api_key = st.text_input("Update API Key:", type="password")
-            if st.button("Update"):
-                if new_api_key:
-                    st.session_state.api_key = new_api_key
-                    st.success("API key updated!")
-                    st.rerun()  # Updated from experimental_rerun()
\ No newline at end of file
+        render_sidebar()
@@ -1,44 +1,98 @@
 from dotenv import load_dotenv
 import os
-import json
+import orjson
 import datetime
+import functools
+import hashlib
 import random
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 from openai import OpenAI
-import wikipedia
 import re
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(
-    api_key=os.getenv("GROQ_API_KEY"),
-    base_url="https://api.groq.com/openai/v1"
-)
+# OpenAI client, created on first use: the Streamlit app imports the tools
+# from this module but brings its own client and API key. Every step of a
+# session goes over the same keep-alive HTTP/2 connection to Groq.
+@functools.lru_cache(maxsize=None)
+def get_client():
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=300.0),
+        timeout=30.0
+    )
+    return OpenAI(
+        api_key=os.getenv("GROQ_API_KEY"),
+        base_url="https://api.groq.com/openai/v1",
+        http_client=http_client
+    )
 
 # Database setup and helper functions
 class StudyBuddyDB:
-    def __init__(self, db_path="study_buddy.db"):
+    def __init__(self, db_path="study_buddy.db", pool_size=5):
         self.db_path = db_path
+        self._user_ids = {}
+        # Latest plan id per user, kept current by create_study_plan
+        self._plan_ids = {}
+
+        # Connections are opened once and reused: one writer behind a lock
+        # (SQLite allows a single writer anyway) and a pool of readers
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._readers = queue.Queue()
+        for _ in range(pool_size):
+            self._readers.put(self._connect())
+
         self.setup_database()
 
-    @contextmanager
-    def get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self):
+        """Open a connection that can be shared between threads"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        # WAL lets the readers run while a write is in progress
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Safe under WAL, and commits no longer wait on an fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Keep the working set in memory: 64 MiB page cache, 256 MiB mmap
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    @contextmanager
+    def get_connection(self, write=False):
+        """Context manager for database connections, borrowed from the pool"""
+        if write:
+            self._write_lock.acquire()
+            conn = self._writer
+        else:
+            conn = self._readers.get()
         try:
             yield conn
         finally:
-            conn.close()
+            # Don't hand a half-finished transaction to the next borrower
+            if conn.in_transaction:
+                conn.rollback()
+            if write:
+                self._write_lock.release()
+            else:
+                self._readers.put(conn)
 
     def setup_database(self):
         """Create necessary tables if they don't exist"""
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
             # Users table
@@ -75,6 +129,21 @@ class StudyBuddyDB:
             )
             ''')
 
+            # Every plan lookup wants a user's most recent plan
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_plans_user_created ON study_plans (user_id, created_at DESC)
+            ''')
+
+            # Topic progress updates look topics up by plan and name
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_topics_plan_topic ON topics (plan_id, topic)
+            ''')
+
+            # Loading a plan reads its topics in day order
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_topics_plan_day ON topics (plan_id, day)
+            ''')
+
             # Quizzes table - removed the problematic comment
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS quizzes (
@@ -87,29 +156,89 @@ class StudyBuddyDB:
             )
             ''')
 
+            # Quiz questions table - one row per question so answer checks can search in SQL
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quiz_questions (
+                quiz_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                options TEXT,
+                FOREIGN KEY (quiz_id) REFERENCES quizzes (id)
+            )
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_quiz_questions_quiz ON quiz_questions (quiz_id, position)
+            ''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_quizzes_user_created ON quizzes (user_id, created_at DESC)
+            ''')
+            # Quiz history for a single topic
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_quizzes_user_topic ON quizzes (user_id, topic, created_at DESC)
+            ''')
+
+            # Fill in questions for quizzes saved before the table existed
+            cursor.execute('''
+            INSERT INTO quiz_questions (quiz_id, position, question, answer, options)
+            SELECT q.id, j.key, json_extract(j.value, '$.question'), json_extract(j.value, '$.answer'),
+                   json_extract(j.value, '$.options')
+            FROM quizzes q, json_each(q.questions) j
+            WHERE NOT EXISTS (SELECT 1 FROM quiz_questions qq WHERE qq.quiz_id = q.id)
+            ''')
+
+            # Web cache table - scraped tool output keyed by tool and query
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS web_cache (
+                tool TEXT NOT NULL,
+                query TEXT NOT NULL,
+                content TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                hits INTEGER DEFAULT 0,
+                last_used REAL,
+                PRIMARY KEY (tool, query)
+            )
+            ''')
+
+            # Caches created before entries were evicted by last use
+            cursor.execute("PRAGMA table_info(web_cache)")
+            if "last_used" not in {column['name'] for column in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE web_cache ADD COLUMN last_used REAL")
+                cursor.execute("UPDATE web_cache SET last_used = fetched_at")
+
+            # Eviction drops each tool's least recently used entries
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_web_cache_tool_used ON web_cache (tool, last_used)
+            ''')
+
             conn.commit()
 
     def get_or_create_user(self, username):
         """Get user ID or create a new user"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Check if user exists
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
+        # Every tool call looks the user up, and a username's id never changes
+        user_id = self._user_ids.get(username)
+        if user_id is not None:
+            return user_id
 
-            if user:
-                return user['id']
+        with self.get_connection(write=True) as conn:
+            cursor = conn.cursor()
 
-            # Create new user
-            cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
+            # Create the user if needed; the no-op update makes RETURNING give
+            # back the id of an existing user too (needs SQLite 3.35+)
+            cursor.execute("""
+                INSERT INTO users (username) VALUES (?)
+                ON CONFLICT (username) DO UPDATE SET username = excluded.username
+                RETURNING id
+            """, (username,))
+            user_id = cursor.fetchone()['id']
             conn.commit()
 
-            return cursor.lastrowid
+        self._user_ids[username] = user_id
+        return user_id
 
     def create_study_plan(self, user_id, subject, goal, topics):
         """Create a new study plan with topics"""
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
             # Create study plan
@@ -119,62 +248,86 @@ class StudyBuddyDB:
             )
             plan_id = cursor.lastrowid
 
-            # Add topics
-            for topic in topics:
-                cursor.execute(
-                    "INSERT INTO topics (plan_id, day, topic, completed, progress) VALUES (?, ?, ?, ?, ?)",
-                    (plan_id, topic["day"], topic["topic"], topic["completed"], 0)
-                )
+            # Add topics in one batch; they commit together with the plan
+            cursor.executemany(
+                "INSERT INTO topics (plan_id, day, topic, completed, progress) VALUES (?, ?, ?, ?, ?)",
+                [(plan_id, topic["day"], topic["topic"], topic["completed"], 0) for topic in topics]
+            )
 
             conn.commit()
+            self._plan_ids[user_id] = plan_id
             return plan_id
 
-    def get_current_study_plan(self, user_id):
-        """Get the most recent study plan for a user"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Get most recent plan
+    def _latest_plan_id(self, cursor, user_id):
+        """Id of the user's most recent plan (or None), only queried the first time"""
+        plan_id = self._plan_ids.get(user_id)
+        if plan_id is None:
+            # created_at only has second precision, so the id breaks ties
             cursor.execute("""
-                SELECT id, subject, goal
-                FROM study_plans
+                SELECT id FROM study_plans
                 WHERE user_id = ?
-                ORDER BY created_at DESC
+                ORDER BY created_at DESC, id DESC
                 LIMIT 1
             """, (user_id,))
-
             plan = cursor.fetchone()
             if not plan:
                 return None
+            plan_id = self._plan_ids[user_id] = plan['id']
+        return plan_id
 
-            # Get topics for this plan
-            cursor.execute("""
-                SELECT day, topic, completed, progress
-                FROM topics
-                WHERE plan_id = ?
-                ORDER BY day
-            """, (plan['id'],))
+    def get_current_study_plan(self, user_id):
+        """Get the most recent study plan for a user"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+
+            # Get most recent plan
+            plan_id = self._latest_plan_id(cursor, user_id)
+            if plan_id is None:
+                return None
 
-            topics = [dict(topic) for topic in cursor.fetchall()]
+            # The plan and its topics in one query; the LEFT JOIN still returns
+            # the plan (with NULL topic columns) when it has no topics
+            cursor.execute("""
+                SELECT sp.subject, sp.goal, t.day, t.topic, t.completed, t.progress
+                FROM study_plans sp
+                LEFT JOIN topics t ON t.plan_id = sp.id
+                WHERE sp.id = ?
+                ORDER BY t.day
+            """, (plan_id,))
+
+            # Read before the connection goes back to the pool
+            rows = cursor.fetchall()
+            if not rows:
+                return None
 
             return {
-                "subject": plan['subject'],
-                "goal": plan['goal'],
-                "study_plan": topics
+                "subject": rows[0]['subject'],
+                "goal": rows[0]['goal'],
+                "study_plan": [
+                    {"day": row['day'], "topic": row['topic'], "completed": row['completed'], "progress": row['progress']}
+                    for row in rows if row['topic'] is not None
+                ]
             }
 
     def save_quiz(self, user_id, topic, questions):
         """Save a quiz to the database"""
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
             cursor.execute(
                 "INSERT INTO quizzes (user_id, topic, questions) VALUES (?, ?, ?)",
-                (user_id, topic, json.dumps(questions))
+                (user_id, topic, orjson.dumps(questions).decode())
+            )
+            quiz_id = cursor.lastrowid
+
+            cursor.executemany(
+                "INSERT INTO quiz_questions (quiz_id, position, question, answer, options) VALUES (?, ?, ?, ?, ?)",
+                [(quiz_id, position, question["question"], question["answer"], orjson.dumps(question.get("options")).decode())
+                 for position, question in enumerate(questions)]
             )
 
             conn.commit()
-            return cursor.lastrowid
+            return quiz_id
 
     def get_quizzes(self, user_id, topic=None):
         """Get quizzes for a user, optionally filtered by topic"""
@@ -197,63 +350,77 @@ class StudyBuddyDB:
                 """, (user_id,))
 
             quizzes = []
-            for quiz in cursor.fetchall():
+            for quiz in cursor:
                 quiz_dict = dict(quiz)
-                quiz_dict['questions'] = json.loads(quiz_dict['questions'])
+                quiz_dict['questions'] = orjson.loads(quiz_dict['questions'])
                 quizzes.append(quiz_dict)
 
             return quizzes
 
-    def update_topic_progress(self, user_id, topic_name, progress_value):
-        """Update progress for a specific topic"""
-        with self.get_connection() as conn:
+    def grade_quiz_answer(self, user_id, question_text, user_answer, progress_step=50):
+        """Check an answer and bump the topic's progress when it is correct.
+
+        Returns (correct_answer, is_correct), or None if the question isn't in the quiz history.
+        """
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
-            # Get the most recent plan
             cursor.execute("""
-                SELECT id FROM study_plans
-                WHERE user_id = ?
-                ORDER BY created_at DESC
+                SELECT qq.answer, q.topic
+                FROM quizzes q
+                JOIN quiz_questions qq ON qq.quiz_id = q.id
+                WHERE q.user_id = ? AND instr(qq.question, ?) > 0
+                ORDER BY q.created_at DESC, qq.position
                 LIMIT 1
-            """, (user_id,))
+            """, (user_id, question_text))
+            match = cursor.fetchone()
+            if not match or not match['answer']:
+                return None
 
-            plan = cursor.fetchone()
-            if not plan:
-                return False
+            is_correct = user_answer.lower() == match['answer'].lower()
+            plan_id = self._latest_plan_id(cursor, user_id) if is_correct and match['topic'] else None
+            if plan_id is not None:
+                cursor.execute("""
+                    UPDATE topics
+                    SET progress = MIN(100, progress + ?)
+                    WHERE topic = ? AND plan_id = ?
+                """, (progress_step, match['topic'], plan_id))
+                conn.commit()
+
+            return match['answer'], is_correct
+
+    def update_topic_progress(self, user_id, topic_name, progress_value):
+        """Update progress for a specific topic"""
+        with self.get_connection(write=True) as conn:
+            cursor = conn.cursor()
 
-            # Update the topic
+            # Update the topic in the most recent plan
+            plan_id = self._latest_plan_id(cursor, user_id)
+            if plan_id is None:
+                return False
             cursor.execute("""
                 UPDATE topics
                 SET progress = ?
-                WHERE plan_id = ? AND topic = ?
-            """, (progress_value, plan['id'], topic_name))
+                WHERE topic = ? AND plan_id = ?
+            """, (progress_value, topic_name, plan_id))
 
             conn.commit()
             return cursor.rowcount > 0
 
     def mark_topic_complete(self, user_id, topic_name):
         """Mark a topic as completed"""
-        with self.get_connection() as conn:
+        with self.get_connection(write=True) as conn:
             cursor = conn.cursor()
 
-            # Get the most recent plan
-            cursor.execute("""
-                SELECT id FROM study_plans
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id,))
-
-            plan = cursor.fetchone()
-            if not plan:
+            # Update the topic in the most recent plan
+            plan_id = self._latest_plan_id(cursor, user_id)
+            if plan_id is None:
                 return False
-
-            # Update the topic
             cursor.execute("""
                 UPDATE topics
                 SET completed = 1, progress = 100
-                WHERE plan_id = ? AND topic = ?
-            """, (plan['id'], topic_name))
+                WHERE topic = ? AND plan_id = ?
+            """, (topic_name, plan_id))
 
             conn.commit()
             return cursor.rowcount > 0
@@ -263,47 +430,208 @@ class StudyBuddyDB:
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
-            # Get the most recent plan
-            cursor.execute("""
-                SELECT id, subject FROM study_plans
-                WHERE user_id = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id,))
-
-            plan = cursor.fetchone()
-            if not plan:
+            plan_id = self._latest_plan_id(cursor, user_id)
+            if plan_id is None:
                 return None
 
             if topic:
+                # Topic in the most recent plan
                 cursor.execute("""
                     SELECT progress
                     FROM topics
-                    WHERE plan_id = ? AND topic = ?
-                """, (plan['id'], topic))
+                    WHERE topic = ? AND plan_id = ?
+                """, (topic, plan_id))
 
                 result = cursor.fetchone()
                 if result:
                     return {"topic": topic, "progress": result['progress']}
                 return None
             else:
+                # Most recent plan with its average topic progress; the LEFT JOIN
+                # keeps a plan without topics
                 cursor.execute("""
-                    SELECT AVG(progress) as overall_progress
-                    FROM topics
-                    WHERE plan_id = ?
-                """, (plan['id'],))
+                    SELECT sp.subject, AVG(t.progress) as overall_progress
+                    FROM study_plans sp
+                    LEFT JOIN topics t ON t.plan_id = sp.id
+                    WHERE sp.id = ?
+                """, (plan_id,))
 
                 result = cursor.fetchone()
+                if result['subject'] is None:
+                    return None
                 return {
-                    "subject": plan['subject'],
+                    "subject": result['subject'],
                     "overall_progress": round(result['overall_progress']) if result['overall_progress'] is not None else 0
                 }
 
+    def get_cached_result(self, tool, query, max_age):
+        """Get cached tool output if it is younger than max_age seconds"""
+        with self.get_connection(write=True) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                SELECT content FROM web_cache
+                WHERE tool = ? AND query = ? AND fetched_at > ?
+            """, (tool, query, time.time() - max_age))
+
+            row = cursor.fetchone()
+            if not row:
+                return None
+
+            cursor.execute(
+                "UPDATE web_cache SET hits = hits + 1, last_used = ? WHERE tool = ? AND query = ?",
+                (time.time(), tool, query)
+            )
+            conn.commit()
+            return row['content']
+
+    def cache_result(self, tool, query, content, max_age, max_rows=1000):
+        """Store tool output, dropping expired entries and the tool's least recently used past max_rows"""
+        now = time.time()
+        with self.get_connection(write=True) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                "INSERT OR REPLACE INTO web_cache (tool, query, content, fetched_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (tool, query, content, now, now)
+            )
+
+            # Expired entries can never be served again
+            cursor.execute(
+                "DELETE FROM web_cache WHERE tool = ? AND fetched_at <= ?",
+                (tool, now - max_age)
+            )
+
+            # Each tool gets its own max_rows; the entry just stored is the most
+            # recently used, so it is never the one evicted
+            cursor.execute("""
+                DELETE FROM web_cache
+                WHERE rowid IN (
+                    SELECT rowid FROM web_cache
+                    WHERE tool = ?
+                    ORDER BY last_used DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (tool, max(1, max_rows)))
+
+            conn.commit()
+
 # Initialize the database
 db = StudyBuddyDB()
 
+@functools.lru_cache(maxsize=1)
+def _date_for_hour(hour):
+    return datetime.date.today().isoformat()
+
+def _today():
+    """Today's date as YYYY-MM-DD, formatted at most once an hour"""
+    return _date_for_hour(int(time.time()) // 3600)
+
+# Shared HTTP session so the scrapers reuse TCP/TLS connections across calls
+_http = requests.Session()
+# Failed connects, rate limits and gateway errors are retried; a read timeout
+# isn't, since a site that was slow once is likely slow again. raise_on_status=False
+# hands the last response back so _get_page can skip the site instead of raising,
+# and Retry-After is ignored so a server can't stretch the wait.
+_http_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                            max_retries=Retry(total=2, read=0, backoff_factor=0.2,
+                                              status_forcelist=(429, 500, 502, 503, 504),
+                                              raise_on_status=False,
+                                              respect_retry_after_header=False))
+_http.mount('https://', _http_adapter)
+_http.mount('http://', _http_adapter)
+_http.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+# (connect, read) seconds per attempt. With up to three attempts and under a
+# second of backoff, one request can hold a tool worker for about 31 s at worst;
+# a site that stops responding mid-read gives up after a single 7 s wait.
+HTTP_TIMEOUT = (3, 7)
+
+# Compiled XPath queries run by lxml in C over the scraped pages, instead of
+# a Python-level tree walk per find() call.
+# Result elements, matched on a class name containing these words
+_KHAN_RESULTS = etree.XPath("//a[contains(@class, 'result')]")
+_COURSERA_CARDS = etree.XPath("//div[contains(@class, 'card')]")
+_OCW_CARDS = etree.XPath("//div[contains(@class, 'course-card')]")
+
+# Fields within one result element; missing fields come back as ""
+_TEXT = etree.XPath("normalize-space(.)")
+_H2_TEXT = etree.XPath("normalize-space((.//h2)[1])")
+_H3_TEXT = etree.XPath("normalize-space((.//h3)[1])")
+_HREF = etree.XPath("string(@href)")
+_FIRST_LINK_HREF = etree.XPath("string((.//a)[1]/@href)")
+
+# arXiv's export API returns an Atom feed with the paper fields already structured
+ARXIV_API = "https://export.arxiv.org/api/query"
+_ATOM_NS = {"atom": "http://www.w3.org/2005/Atom"}
+_ARXIV_ENTRIES = etree.XPath("/atom:feed/atom:entry", namespaces=_ATOM_NS)
+_ARXIV_TITLE = etree.XPath("normalize-space(atom:title)", namespaces=_ATOM_NS)
+_ARXIV_AUTHORS = etree.XPath("atom:author/atom:name/text()", namespaces=_ATOM_NS)
+_ARXIV_ABSTRACT = etree.XPath("normalize-space(atom:summary)", namespaces=_ATOM_NS)
+_ARXIV_LINK = etree.XPath("normalize-space(atom:id)", namespaces=_ATOM_NS)
+
+WIKIPEDIA_API = "https://en.wikipedia.org/w/api.php"
+
+# Section headings in a plain-text extract, e.g. "\n\n\n== History ==\n"
+_WIKI_HEADING_RE = re.compile(r"\n+={2,} *(.+?) *={2,}(?=\n|$)")
+
+# Runs the independent per-site requests of one scraper concurrently
+_fetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="fetch")
+
+# How long scraped results stay fresh in the web cache, in seconds
+WEB_CACHE_TTL = 24 * 60 * 60
+WIKIPEDIA_CACHE_TTL = 7 * 24 * 60 * 60
+
+def cached_tool(max_age):
+    """
+    Caches a scraping tool's output in the database for max_age seconds.
+    Results don't depend on the user, so only the query is part of the key.
+    The tool returns (content, cacheable); only content is passed on, and it
+    is stored only when cacheable is true.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(query, username="default_user"):
+            if not isinstance(query, str):
+                # Let the tool report the bad input in its own error message
+                return fn(query, username)[0]
+
+            key = " ".join(query.lower().split())
+            content = db.get_cached_result(fn.__name__, key, max_age)
+            if content is not None:
+                return content
+
+            content, cacheable = fn(query, username)
+            if cacheable:
+                db.cache_result(fn.__name__, key, content, max_age)
+            return content
+        return wrapper
+    return decorator
+
 # Tool functions
 
+# Topics for known subjects, picked by the first entry with a keyword in the subject
+SUBJECT_TOPICS = (
+    (("math", "algebra"), (
+        "Linear Equations", "Quadratic Equations", "Inequalities",
+        "Functions and Graphs", "Exponents and Radicals", "Polynomials",
+        "Factoring", "Rational Expressions", "Systems of Equations"
+    )),
+    (("history",), (
+        "Ancient Civilizations", "Middle Ages", "Renaissance",
+        "Industrial Revolution", "World War I", "World War II",
+        "Cold War", "Modern Era", "Historical Analysis Methods"
+    )),
+    (("science", "physics"), (
+        "Mechanics", "Thermodynamics", "Waves", "Electricity",
+        "Magnetism", "Optics", "Modern Physics", "Quantum Mechanics",
+        "Relativity"
+    )),
+)
+
+# Timelines like "in 3 weeks", "10 days" or "a 2-month plan"
+_TIMELINE_RE = re.compile(r"(\d+)\s*-?\s*(day|week|month)s?\b", re.IGNORECASE)
+TIMELINE_UNIT_DAYS = {"day": 1, "week": 7, "month": 30}
+
 def create_study_plan(subject_and_goal, username="default_user"):
     """
     Creates a personalized study plan based on subject and timeline.
@@ -318,33 +646,17 @@ def create_study_plan(subject_and_goal, username="default_user"):
 
     # Extract timeline if available
     timeline_days = 14  # Default 2 weeks
-    if "week" in goal.lower():
-        try:
-            weeks = [int(s) for s in goal.split() if s.isdigit()][0]
-            timeline_days = weeks * 7
-        except:
-            pass
+    match = _TIMELINE_RE.search(goal)
+    if match and int(match.group(1)) > 0:
+        timeline_days = int(match.group(1)) * TIMELINE_UNIT_DAYS[match.group(2).lower()]
 
     # Generate topics based on subject
-    if "math" in subject.lower() or "algebra" in subject.lower():
-        topics = [
-            "Linear Equations", "Quadratic Equations", "Inequalities",
-            "Functions and Graphs", "Exponents and Radicals", "Polynomials",
-            "Factoring", "Rational Expressions", "Systems of Equations"
-        ]
-    elif "history" in subject.lower():
-        topics = [
-            "Ancient Civilizations", "Middle Ages", "Renaissance",
-            "Industrial Revolution", "World War I", "World War II",
-            "Cold War", "Modern Era", "Historical Analysis Methods"
-        ]
-    elif "science" in subject.lower() or "physics" in subject.lower():
-        topics = [
-            "Mechanics", "Thermodynamics", "Waves", "Electricity",
-            "Magnetism", "Optics", "Modern Physics", "Quantum Mechanics",
-            "Relativity"
-        ]
-    else:
+    subject_lower = subject.lower()
+    topics = next(
+        (topics for keywords, topics in SUBJECT_TOPICS if any(keyword in subject_lower for keyword in keywords)),
+        None
+    )
+    if topics is None:
         topics = [
             f"{subject} Fundamentals", f"{subject} Intermediate Concepts",
             f"{subject} Advanced Topics", f"{subject} Practical Applications",
@@ -398,6 +710,37 @@ def answer_question(question, username="default_user"):
 
         return f"Based on {subject}, here's a possible answer to your question: {question}\n\nThis would be generated by an LLM in a real implementation, providing a detailed and accurate answer to your specific question."
 
+# Sample quizzes for common topics, keyed by lowercase topic name
+TOPIC_QUIZZES = {
+    "linear equations": [
+        {
+            "question": "Solve for x: 3x + 5 = 14",
+            "options": ["x = 3", "x = 4", "x = 5", "x = 6"],
+            "answer": "x = 3"
+        },
+        {
+            "question": "Solve for y: 2y - 8 = 12",
+            "options": ["y = 4", "y = 8", "y = 10", "y = 12"],
+            "answer": "y = 10"
+        }
+    ],
+    "quadratic equations": [
+        {
+            "question": "Solve for x: x² - 5x + 6 = 0",
+            "options": ["x = 2, x = 3", "x = -2, x = -3", "x = 1, x = 6", "x = -1, x = -6"],
+            "answer": "x = 2, x = 3"
+        },
+        {
+            "question": "What is the discriminant of x² + 4x + 4 = 0?",
+            "options": ["0", "4", "8", "16"],
+            "answer": "0"
+        }
+    ]
+}
+
+# Labels for multiple-choice options, in order
+OPTION_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
 def generate_quiz(topic, username="default_user"):
     """
     Generates a quiz on a specific topic.
@@ -406,46 +749,21 @@ def generate_quiz(topic, username="default_user"):
     print("🛠️: Tool called: generate_quiz:", topic)
 
     # In a real implementation, you would use an LLM to generate relevant questions
-    # For this example, we'll create sample quizzes for common topics
-
-    quizzes = {
-        "linear equations": [
-            {
-                "question": "Solve for x: 3x + 5 = 14",
-                "options": ["x = 3", "x = 4", "x = 5", "x = 6"],
-                "answer": "x = 3"
-            },
-            {
-                "question": "Solve for y: 2y - 8 = 12",
-                "options": ["y = 4", "y = 8", "y = 10", "y = 12"],
-                "answer": "y = 10"
-            }
-        ],
-        "quadratic equations": [
-            {
-                "question": "Solve for x: x² - 5x + 6 = 0",
-                "options": ["x = 2, x = 3", "x = -2, x = -3", "x = 1, x = 6", "x = -1, x = -6"],
-                "answer": "x = 2, x = 3"
-            },
-            {
-                "question": "What is the discriminant of x² + 4x + 4 = 0?",
-                "options": ["0", "4", "8", "16"],
-                "answer": "0"
-            }
-        ]
-    }
+    # For this example, we'll use the sample quizzes for common topics
 
     topic_lower = topic.lower()
     quiz = {}
 
-    for key in quizzes:
-        if key in topic_lower or topic_lower in key:
-            quiz = {
-                "topic": topic,
-                "questions": quizzes[key],
-                "date": datetime.datetime.now().strftime("%Y-%m-%d")
-            }
-            break
+    # Exact topic names are a dict hit; otherwise match either way round
+    questions = TOPIC_QUIZZES.get(topic_lower)
+    if questions is None:
+        questions = next((qs for key, qs in TOPIC_QUIZZES.items() if key in topic_lower or topic_lower in key), None)
+    if questions is not None:
+        quiz = {
+            "topic": topic,
+            "questions": questions,
+            "date": _today()
+        }
 
     # If no predefined quiz, create a generic one
     if not quiz:
@@ -463,7 +781,7 @@ def generate_quiz(topic, username="default_user"):
                     "answer": "Third choice"
                 }
             ],
-            "date": datetime.datetime.now().strftime("%Y-%m-%d")
+            "date": _today()
         }
 
     # Save quiz to database
@@ -471,14 +789,13 @@ def generate_quiz(topic, username="default_user"):
     db.save_quiz(user_id, topic, quiz["questions"])
 
     # Format quiz for return
-    formatted_quiz = f"Quiz on {topic}:\n\n"
-    for i, q in enumerate(quiz["questions"]):
-        formatted_quiz += f"{i+1}. {q['question']}\n"
-        for j, option in enumerate(q["options"]):
-            formatted_quiz += f"   {chr(97+j)}) {option}\n"
-        formatted_quiz += "\n"
+    parts = [f"Quiz on {topic}:\n\n"]
+    for i, q in enumerate(quiz["questions"], 1):
+        parts.append(f"{i}. {q['question']}\n")
+        parts.extend(f"   {letter}) {option}\n" for letter, option in zip(OPTION_LETTERS, q["options"]))
+        parts.append("\n")
 
-    return formatted_quiz
+    return "".join(parts)
 
 def check_quiz_answer(answer_submission, username="default_user"):
     """
@@ -495,30 +812,15 @@ def check_quiz_answer(answer_submission, username="default_user"):
     user_answer = parts[1]
 
     user_id = db.get_or_create_user(username)
-    quizzes = db.get_quizzes(user_id)
 
-    # Find the question in quiz history
-    correct_answer = None
-    topic = None
+    # Find the question in quiz history and credit the topic if the answer is right
+    result = db.grade_quiz_answer(user_id, question_text, user_answer)
 
-    for quiz in quizzes:
-        for question in quiz["questions"]:
-            if question_text in question["question"]:
-                correct_answer = question["answer"]
-                topic = quiz["topic"]
-                break
-        if correct_answer:
-            break
-
-    if not correct_answer:
+    if result is None:
         return "Question not found in quiz history."
+    correct_answer, is_correct = result
 
-    # Check answer
-    if user_answer.lower() == correct_answer.lower():
-        # Update progress if the topic is in the progress tracker
-        if topic:
-            db.update_topic_progress(user_id, topic, min(100, 50))  # +50% progress
-
+    if is_correct:
         return f"Great job! '{user_answer}' is correct!"
     else:
         return f"Not quite. The correct answer is '{correct_answer}'. Keep practicing!"
@@ -545,20 +847,9 @@ def track_progress(topic=None, username="default_user"):
         else:
             return "No progress data available. Please create a study plan first."
 
-def retrieve_learning_material(topic, username="default_user"):
-    """
-    Retrieves learning materials for a specific topic.
-    Input format: "Linear Equations"
-    """
-    print("🛠️: Tool called: retrieve_learning_material:", topic)
-
-    # In a real implementation, this would fetch from a content database or generate with an LLM
-    # For this example, we'll return simulated learning content
-
-    topic_lower = topic.lower()
-
-    if "linear equation" in topic_lower:
-        return """
+# Sample learning material, keyed by a phrase the topic has to contain
+LEARNING_MATERIAL = {
+    "linear equation": """
 ## Linear Equations
 
 A linear equation is an equation that forms a straight line when graphed. It is usually written in the form:
@@ -575,9 +866,8 @@ where a, b, and c are constants.
 3x + 5 = 14
 3x = 9
 x = 3
-"""
-    elif "quadratic" in topic_lower:
-        return """
+""",
+    "quadratic": """
 ## Quadratic Equations
 
 A quadratic equation is a second-degree polynomial equation in the form:
@@ -594,9 +884,27 @@ where a ≠ 0.
 x² - 5x + 6 = 0
 (x - 2)(x - 3) = 0
 x = 2 or x = 3
-"""
-    else:
-        return f"""
+""",
+}
+
+def retrieve_learning_material(topic, username="default_user"):
+    """
+    Retrieves learning materials for a specific topic.
+    Input format: "Linear Equations"
+    """
+    print("🛠️: Tool called: retrieve_learning_material:", topic)
+
+    # In a real implementation, this would fetch from a content database or generate with an LLM
+    # For this example, we'll return simulated learning content
+
+    topic_lower = topic.lower()
+
+    # First phrase contained in the topic wins
+    material = next((content for phrase, content in LEARNING_MATERIAL.items() if phrase in topic_lower), None)
+    if material is not None:
+        return material
+
+    return f"""
 ## {topic}
 
 This is an overview of {topic}.
@@ -627,6 +935,7 @@ def mark_topic_complete(topic, username="default_user"):
         return f"Topic '{topic}' not found in your study plan."
 
 # New tools for accessing live information
+@cached_tool(WIKIPEDIA_CACHE_TTL)
 def search_wikipedia(query, username="default_user"):
     """
     Searches Wikipedia for information on a specific topic.
@@ -635,42 +944,102 @@ def search_wikipedia(query, username="default_user"):
     print("🛠️: Tool called: search_wikipedia:", query)
 
     try:
-        # Search Wikipedia
-        search_results = wikipedia.search(query, results=3)
-
-        if not search_results:
-            return f"No Wikipedia results found for '{query}'."
-
-        # Get the page for the first result
-        try:
-            page = wikipedia.page(search_results[0], auto_suggest=False)
-        except wikipedia.DisambiguationError as e:
-            # If disambiguation page, take the first option
-            page = wikipedia.page(e.options[0], auto_suggest=False)
-
-        # Get summary and sections
-        summary = page.summary
-        content = f"# {page.title}\n\n{summary}\n\n"
+        # Search and fetch the top article's full plain text in one API call
+        response = _http.get(WIKIPEDIA_API, params={
+            "action": "query",
+            "generator": "search",
+            "gsrsearch": query,
+            "gsrlimit": 1,
+            "prop": "extracts|info",
+            "explaintext": 1,
+            "inprop": "url",
+            "redirects": 1,
+            "format": "json",
+            "formatversion": 2,
+        }, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        pages = response.json().get("query", {}).get("pages")
+
+        if not pages:
+            return f"No Wikipedia results found for '{query}'.", True
+
+        page = pages[0]
+
+        # Split into [summary, heading, text, heading, text, ...]
+        chunks = _WIKI_HEADING_RE.split(page.get("extract", ""))
+        parts = [f"# {page['title']}\n\n{chunks[0].strip()}\n\n"]
 
         # Add a few sections if available
-        if len(page.sections) > 0:
-            for section in page.sections[:3]:  # Limit to first 3 sections
-                try:
-                    section_content = page.section(section)
-                    if section_content and len(section_content) > 10:  # Only add non-empty sections
-                        content += f"## {section}\n\n{section_content}\n\n"
-                except:
-                    pass
+        for section, section_content in zip(chunks[1:7:2], chunks[2:7:2]):  # Limit to first 3 sections
+            section_content = section_content.strip()
+            if len(section_content) > 10:  # Only add non-empty sections
+                parts.append(f"## {section}\n\n{section_content}\n\n")
 
         # Add reference
-        content += f"\nSource: Wikipedia, Retrieved on {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        content += f"\nURL: {page.url}"
+        parts.append(f"\nSource: Wikipedia, Retrieved on {_today()}")
+        parts.append(f"\nURL: {page['fullurl']}")
 
-        return content
+        return "".join(parts), True
 
     except Exception as e:
-        return f"Error searching Wikipedia: {str(e)}"
+        return f"Error searching Wikipedia: {str(e)}", False
 
+def _get_page(url, params=None):
+    """Fetches a page's text, or None if the site timed out or returned an error."""
+    try:
+        response = _http.get(url, params=params, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        # Skip just this site so the other results are still returned. Timeouts
+        # arrive here as ConnectionError once urllib3's retries are used up.
+        return None
+    return response.text if response.status_code == 200 else None
+
+def _khan_academy_results(query):
+    """Scrapes Khan Academy search results into a markdown section, or None if the site couldn't be reached."""
+    url = f"https://www.khanacademy.org/search?page_search_query={query.replace(' ', '+')}"
+    page = _get_page(url)
+    if page is None:
+        return None
+
+    parts = []
+    if page:
+        # Try to find search results
+        results = _KHAN_RESULTS(lxml_html.fromstring(page))
+
+        if results:
+            parts.append("## Khan Academy Resources:\n\n")
+            for idx, result in enumerate(results[:5]):  # Limit to 5 results
+                title = _TEXT(result)
+                href = _HREF(result)
+                link = "https://www.khanacademy.org" + href if href else ""
+                if title and link:
+                    parts.append(f"{idx+1}. [{title}]({link})\n")
+    return "".join(parts)
+
+def _coursera_results(query):
+    """Scrapes Coursera course cards into a markdown section, or None if the site couldn't be reached."""
+    url = f"https://www.coursera.org/search?query={query.replace(' ', '%20')}"
+    page = _get_page(url)
+    if page is None:
+        return None
+
+    parts = []
+    if page:
+        # Try to find course cards
+        results = _COURSERA_CARDS(lxml_html.fromstring(page))
+
+        if results:
+            parts.append("\n## Coursera Courses:\n\n")
+            for idx, result in enumerate(results[:5]):  # Limit to 5 results
+                title = _H2_TEXT(result) or _H3_TEXT(result)
+                href = _FIRST_LINK_HREF(result)
+                link = "https://www.coursera.org" + href if href else ""
+
+                if title and link:
+                    parts.append(f"{idx+1}. [{title}]({link})\n")
+    return "".join(parts)
+
+@cached_tool(WEB_CACHE_TTL)
 def search_web(query, username="default_user"):
     """
     Searches the web for recent information on a topic.
@@ -679,59 +1048,85 @@ def search_web(query, username="default_user"):
     print("🛠️: Tool called: search_web:", query)
 
     try:
-        # Use a search API (simplified for example)
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-
-        # Try to get some educational content from Khan Academy
-        url = f"https://www.khanacademy.org/search?page_search_query={query.replace(' ', '+')}"
-        response = requests.get(url, headers=headers)
-
-        content = f"# Web search results for: {query}\n\n"
-
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Try to find search results
-            results = soup.find_all('a', class_=re.compile('result'))
-
-            if results:
-                content += "## Khan Academy Resources:\n\n"
-                for idx, result in enumerate(results[:5]):  # Limit to 5 results
-                    title = result.get_text(strip=True)
-                    link = "https://www.khanacademy.org" + result['href'] if result.has_attr('href') else ""
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-
-        # Also try to find resources from Coursera
-        url = f"https://www.coursera.org/search?query={query.replace(' ', '%20')}"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Try to find course cards
-            results = soup.find_all('div', class_=re.compile('card'))
-
-            if results:
-                content += "\n## Coursera Courses:\n\n"
-                for idx, result in enumerate(results[:5]):  # Limit to 5 results
-                    title_elem = result.find('h2') or result.find('h3')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-
-                    link_elem = result.find('a')
-                    link = "https://www.coursera.org" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-
-        content += f"\nSearch performed on: {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        return content
+        # Both sites are independent, so fetch them at the same time
+        khan = _fetch_pool.submit(_khan_academy_results, query)
+        coursera = _fetch_pool.submit(_coursera_results, query)
+        sections = [khan.result(), coursera.result()]
+
+        if all(section is None for section in sections):
+            return f"Error searching the web: no site responded for '{query}'", False
+
+        content = "".join([
+            f"# Web search results for: {query}\n\n",
+            *(section or "" for section in sections),
+            f"\nSearch performed on: {_today()}",
+        ])
+        # Results missing a site that failed aren't kept, so the next call retries it
+        return content, None not in sections
 
     except Exception as e:
-        return f"Error searching the web: {str(e)}"
+        return f"Error searching the web: {str(e)}", False
 
+def _arxiv_results(subject):
+    """Queries the arXiv API for papers and formats them as a markdown section, or None if the site couldn't be reached or sent an unreadable feed."""
+    search_query = " AND ".join(f"all:{word}" for word in subject.split())
+    feed = _get_page(ARXIV_API, params={"search_query": search_query, "max_results": 5})
+    if feed is None:
+        return None
+
+    parts = []
+    if feed:
+        try:
+            root = etree.fromstring(feed.encode("utf-8"))
+        except etree.XMLSyntaxError:
+            # A truncated or non-XML reply is treated like a site that didn't respond
+            return None
+
+        # Find paper entries
+        entries = _ARXIV_ENTRIES(root)
+
+        if entries:
+            parts.append("## Recent arXiv Papers:\n\n")
+            for idx, entry in enumerate(entries[:5]):  # Limit to 5 papers
+                title = _ARXIV_TITLE(entry)
+                authors = ", ".join(_ARXIV_AUTHORS(entry))
+                abstract = _ARXIV_ABSTRACT(entry)
+                link = _ARXIV_LINK(entry)
+
+                if title:
+                    parts.append(f"### {idx+1}. {title}\n")
+                    if authors:
+                        parts.append(f"**Authors:** {authors}\n\n")
+                    if abstract:
+                        parts.append(f"**Abstract:** {abstract[:300]}...\n\n")
+                    if link:
+                        parts.append(f"[Read more]({link})\n\n")
+    return "".join(parts)
+
+def _mit_ocw_results(subject):
+    """Scrapes MIT OpenCourseWare course cards into a markdown section, or None if the site couldn't be reached."""
+    url = f"https://ocw.mit.edu/search/?q={subject.replace(' ', '+')}"
+    page = _get_page(url)
+    if page is None:
+        return None
+
+    parts = []
+    if page:
+        # Find course entries
+        entries = _OCW_CARDS(lxml_html.fromstring(page))
+
+        if entries:
+            parts.append("## MIT OpenCourseWare:\n\n")
+            for idx, entry in enumerate(entries[:5]):  # Limit to 5 courses
+                title = _H2_TEXT(entry) or _H3_TEXT(entry)
+                href = _FIRST_LINK_HREF(entry)
+                link = "https://ocw.mit.edu" + href if href else ""
+
+                if title and link:
+                    parts.append(f"{idx+1}. [{title}]({link})\n")
+    return "".join(parts)
+
+@cached_tool(WEB_CACHE_TTL)
 def fetch_academic_resources(subject, username="default_user"):
     """
     Fetches academic resources and papers on a subject.
@@ -740,73 +1135,24 @@ def fetch_academic_resources(subject, username="default_user"):
     print("🛠️: Tool called: fetch_academic_resources:", subject)
 
     try:
-        content = f"# Academic Resources for: {subject}\n\n"
-
-        # Try to get resources from arXiv
-        url = f"https://arxiv.org/search/?query={subject.replace(' ', '+')}&searchtype=all"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Find paper entries
-            entries = soup.find_all('li', class_='arxiv-result')
-
-            if entries:
-                content += "## Recent arXiv Papers:\n\n"
-                for idx, entry in enumerate(entries[:5]):  # Limit to 5 papers
-                    title_elem = entry.find('p', class_='title')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-
-                    authors_elem = entry.find('p', class_='authors')
-                    authors = authors_elem.get_text(strip=True) if authors_elem else ""
-
-                    abstract_elem = entry.find('span', class_='abstract-full')
-                    abstract = abstract_elem.get_text(strip=True) if abstract_elem else ""
-
-                    link_elem = entry.find('a', class_='abstract-full')
-                    link = "https://arxiv.org" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-
-                    if title:
-                        content += f"### {idx+1}. {title}\n"
-                        if authors:
-                            content += f"**Authors:** {authors}\n\n"
-                        if abstract:
-                            content += f"**Abstract:** {abstract[:300]}...\n\n"
-                        if link:
-                            content += f"[Read more]({link})\n\n"
-
-        # Add MIT OpenCourseWare
-        url = f"https://ocw.mit.edu/search/?q={subject.replace(' ', '+')}"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Find course entries
-            entries = soup.find_all('div', class_=re.compile('course-card'))
-
-            if entries:
-                content += "## MIT OpenCourseWare:\n\n"
-                for idx, entry in enumerate(entries[:5]):  # Limit to 5 courses
-                    title_elem = entry.find('h2') or entry.find('h3')
-                    title = title_elem.get_text(strip=True) if title_elem else ""
-
-                    link_elem = entry.find('a')
-                    link = "https://ocw.mit.edu" + link_elem['href'] if link_elem and link_elem.has_attr('href') else ""
-
-                    if title and link:
-                        content += f"{idx+1}. [{title}]({link})\n"
-
-        content += f"\nResources retrieved on: {datetime.datetime.now().strftime('%Y-%m-%d')}"
-        return content
+        # arXiv and MIT OCW are independent, so fetch them at the same time
+        arxiv = _fetch_pool.submit(_arxiv_results, subject)
+        ocw = _fetch_pool.submit(_mit_ocw_results, subject)
+        sections = [arxiv.result(), ocw.result()]
+
+        if all(section is None for section in sections):
+            return f"Error fetching academic resources: no site responded for '{subject}'", False
+
+        content = "".join([
+            f"# Academic Resources for: {subject}\n\n",
+            *(section or "" for section in sections),
+            f"\nResources retrieved on: {_today()}",
+        ])
+        # Results missing a site that failed aren't kept, so the next call retries it
+        return content, None not in sections
 
     except Exception as e:
-        return f"Error fetching academic resources: {str(e)}"
-
+        return f"Error fetching academic resources: {str(e)}", False
 
 # available_tools dictionaries
 available_tools = {
@@ -851,6 +1197,13 @@ available_tools = {
         "description": "Fetches academic resources and papers on a subject. Input format: 'deep learning'"
     }
 }
+
+# Flat name -> function map used by the dispatchers
+TOOL_FNS = {name: spec["fn"] for name, spec in available_tools.items()}
+
+# Tool list for the system prompts, built once from available_tools
+TOOL_DESCRIPTIONS = "\n".join(f"- {name}: {spec['description']}" for name, spec in available_tools.items())
+
 # System prompt
 system_prompt = f"""
 You are Study Buddy AI, a helpful AI assistant specialized in helping students learn effectively.
@@ -877,18 +1230,10 @@ Output JSON format:
     "function": "the name of the function if the step is the action",
     "input": "The input parameter for the function"
 }}
+To run several independent tools at once, send one action step with "calls": [{{"function": "tool name", "input": "tool input"}}, ...]
 
 Available Tools:
-- create_study_plan: Creates a personalized study plan based on subject and timeline. Input format: "Subject: Math, Goal: Master Algebra in 2 weeks"
-- answer_question: Answers a subject-specific question. Input format: "What's 2x + 3 = 7?"
-- generate_quiz: Generates a quiz on a specific topic. Input format: "Linear Equations"
-- check_quiz_answer: Checks a quiz answer against the correct answer. Input format: "Question: Solve for x: 3x + 5 = 14, Answer: x = 3"
-- track_progress: Updates and reports on the user's learning progress. Input can be a specific topic or empty for overall progress.
-- retrieve_learning_material: Retrieves learning materials for a specific topic. Input format: "Linear Equations"
-- mark_topic_complete: Marks a topic as completed in the study plan. Input format: "Linear Equations"
-- search_wikipedia: Searches Wikipedia for information on a specific topic. Input format: "Albert Einstein"
-- search_web: Searches the web for recent information on a topic. Input format: "latest developments in quantum computing"
-- fetch_academic_resources: Fetches academic resources and papers on a subject. Input format: "deep learning"
+{TOOL_DESCRIPTIONS}
 
 Example:
 User Query: I want to learn Math and master Algebra in 2 weeks
@@ -904,53 +1249,255 @@ messages = [
     {"role": "system", "content": system_prompt}
 ]
 
+# Once the CLI history passes MAX_MESSAGES, everything but the system prompt and
+# the last KEEP_MESSAGES is folded into one summary note
+MAX_MESSAGES = 20
+KEEP_MESSAGES = 6
+# Summarising is an easy task, so it goes to a small, fast model
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+
+# Model replies are cached in web_cache, keyed by the exact request, for a day
+LLM_CACHE_TTL = 24 * 60 * 60
+
+# Sent back when a reply isn't valid JSON, at most MAX_INVALID_REPLIES times per query
+INVALID_JSON_MSG = {"role": "user", "content": "Your previous response was not valid JSON. Repeat it in the specified format."}
+MAX_INVALID_REPLIES = 2
+
+def llm_cache_key(messages):
+    """Hash of everything that determines the model's reply to messages"""
+    request = {
+        "model": "meta-llama/llama-4-maverick-17b-128e-instruct",
+        "response_format": {"type": "json_object"},
+        "messages": messages
+    }
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def compact_history(messages):
+    """Summarise older turns so each request doesn't resend the whole session"""
+    if len(messages) <= MAX_MESSAGES:
+        return messages
+
+    older, recent = messages[1:-KEEP_MESSAGES], messages[-KEEP_MESSAGES:]
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in older)
+    try:
+        response = get_client().chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Summarise this study session in a few sentences. Keep the subject, goals, topics covered, quiz results and anything the student asked to remember."},
+                {"role": "user", "content": transcript}
+            ]
+        )
+        summary = response.choices[0].message.content
+    except Exception:
+        # Fall back to a plain sliding window
+        return messages[:1] + recent
+
+    # The system prompt stays the first message so the provider can reuse its cached prefix
+    return messages[:1] + [{"role": "system", "content": f"Summary of the conversation so far: {summary}"}] + recent
+
+# Matches the "content" field of a streamed JSON step, even before its closing quote
+_CONTENT_RE = re.compile(r'"content"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+# Step type of a streamed JSON step, once the model has written it
+_STEP_RE = re.compile(r'"step"\s*:\s*"(\w+)"')
+
+def partial_step_content(buffer):
+    """Extract the (possibly unfinished) "content" value from a partially streamed JSON step"""
+    match = _CONTENT_RE.search(buffer)
+    if not match:
+        return ""
+    text = match.group(1)
+    try:
+        return orjson.loads(f'"{text}"')
+    except ValueError:
+        # Cut off mid escape sequence - show everything before it
+        try:
+            complete = text[:text.rindex("\\")]
+            return orjson.loads(f'"{complete}"')
+        except ValueError:
+            return ""
+
+# Prefix printed before the streamed content of each step type
+STEP_ICONS = {"plan": "🧠", "output": "📚"}
+
+# Opening quote of the "content" value in a streamed JSON step
+_CONTENT_START_RE = re.compile(r'"content"\s*:\s*"')
+
+# Complete characters at the start of a JSON string body, stopping at its closing quote
+_STRING_BODY_RE = re.compile(r'(?:[^"\\]|\\.)*')
+
+# Characters kept from the previous delta so keys split across deltas are still found
+_KEY_OVERLAP = 64
+
+def decode_string_prefix(raw):
+    """
+    Decode the complete start of an unfinished JSON string body.
+    Returns the decoded text, how many raw characters it used, and whether the string ended.
+    """
+    body = _STRING_BODY_RE.match(raw).group(0)
+    closed = len(body) < len(raw) and raw[len(body)] == '"'
+    try:
+        return orjson.loads(f'"{body}"'), len(body), closed
+    except ValueError:
+        # Cut off mid escape sequence (or surrogate pair) - keep it for the next delta
+        try:
+            complete = body[:body.rindex("\\")]
+            return orjson.loads(f'"{complete}"'), len(complete), False
+        except ValueError:
+            return "", 0, False
+
+def stream_step(stream):
+    """
+    Collect a streamed JSON step, printing plan and output text as it arrives.
+    Returns the raw JSON text and whether the step's content was printed.
+    """
+    chunks = []
+    shown = False
+    step = None       # step type, searched for until the model writes it
+    pending = None    # raw content text not printed yet, once its opening quote arrives
+    closed = False
+    tail = ""
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        chunks.append(delta)
+
+        # Only the new text (plus a little overlap) is searched, so each delta costs its own length
+        window = tail + delta
+        tail = window[-_KEY_OVERLAP:]
+        if step is None:
+            match = _STEP_RE.search(window)
+            if match:
+                step = match.group(1)
+        if pending is None:
+            match = _CONTENT_START_RE.search(window)
+            if match:
+                pending = window[match.end():]
+                tail = ""
+        elif not closed:
+            pending += delta
+
+        if step in STEP_ICONS and pending and not closed:
+            text, used, closed = decode_string_prefix(pending)
+            pending = pending[used:]
+            if text:
+                if not shown:
+                    print(f"{STEP_ICONS[step]}: ", end="")
+                    shown = True
+                print(text, end="", flush=True)
+
+    if shown:
+        print()
+    return "".join(chunks), shown
+
+def run_tool(tool_name, tool_input, username):
+    """Run one tool call from an action step"""
+    fn = TOOL_FNS.get(tool_name)
+    if fn is None:
+        return f"Tool '{tool_name}' not found"
+    # Pass username to functions
+    return fn(tool_input, username)
+
 def main():
     print("🤖 Study Buddy AI is ready to help you learn! What's your name?")
     username = input("Username: ")
     print(f"Welcome, {username}! What would you like to study?")
-    
+
+    # History is summarised in the background while the user types the next question
+    history_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+    compacted = None
+    # Runs the calls of a multi-tool action step side by side
+    tool_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool")
+
     while True: 
         query = input("> ")
         if query.lower() in ["exit", "quit", "bye"]:
             print("Thanks for studying with Study Buddy AI! See you next time!")
             break
-            
+
+        if compacted is not None:
+            messages[:] = compacted.result()
+            compacted = None
         messages.append({"role": "user", "content": query})
+        # Plan steps only steer the current query, so they are dropped once it is answered
+        plan_steps = []
+        invalid_replies = 0
 
         while True:
             try:
-                response = client.chat.completions.create(
-                    model="meta-llama/llama-4-maverick-17b-128e-instruct",
-                    response_format={"type":"json_object"},
-                    messages=messages
-                )
-                parsed_response = json.loads(response.choices[0].message.content)
-                messages.append({"role": "assistant", "content": json.dumps(parsed_response)})
-
-                if parsed_response.get("step") == "plan":
-                    print(f"🧠: {parsed_response.get('content')}")
+                # The same conversation so far gets the same step without another API call;
+                # tools in a replayed action step still run for real
+                cache_key = llm_cache_key(messages)
+                raw_response = db.get_cached_result("llm", cache_key, LLM_CACHE_TTL)
+                if raw_response is not None:
+                    printed = False
+                    parsed_response = orjson.loads(raw_response)
+                else:
+                    # Stream the reply so plan and output text shows up as it's generated
+                    stream = get_client().chat.completions.create(
+                        model="meta-llama/llama-4-maverick-17b-128e-instruct",
+                        response_format={"type":"json_object"},
+                        messages=messages,
+                        stream=True
+                    )
+                    raw_response, printed = stream_step(stream)
+                    try:
+                        parsed_response = orjson.loads(raw_response)
+                    except orjson.JSONDecodeError:
+                        # One malformed reply shouldn't end the query - ask for a corrected one
+                        if invalid_replies >= MAX_INVALID_REPLIES:
+                            raise
+                        invalid_replies += 1
+                        messages.append({"role": "assistant", "content": raw_response})
+                        messages.append(INVALID_JSON_MSG)
+                        continue
+                    db.cache_result("llm", cache_key, raw_response, LLM_CACHE_TTL)
+                # The model already sent valid JSON, so keep its text rather than re-serialising
+                messages.append({"role": "assistant", "content": raw_response})
+                step = parsed_response.get("step")
+
+                if step == "plan":
+                    if not printed:
+                        print(f"🧠: {parsed_response.get('content')}")
+                    plan_steps.append(len(messages) - 1)
                     continue
                     
-                if parsed_response.get("step") == "action":
-                    tool_name = parsed_response.get("function")
-                    tool_input = parsed_response.get("input")
-
-                    if tool_name in available_tools:
-                        # Pass username to functions
-                        output = available_tools[tool_name].get("fn")(tool_input, username)
-                        messages.append({"role":"assistant","content": json.dumps({"step": "observe", "output": output})})
-                        continue
+                if step == "action":
+                    calls = parsed_response.get("calls") or [
+                        {"function": parsed_response.get("function"), "input": parsed_response.get("input")}
+                    ]
+
+                    # Independent calls from one action step run concurrently
+                    outputs = list(tool_pool.map(
+                        lambda call: run_tool(call.get("function"), call.get("input"), username), calls
+                    ))
+                    if len(calls) == 1:
+                        observation = {"step": "observe", "output": outputs[0]}
                     else:
-                        messages.append({"role":"assistant","content": json.dumps({"step": "observe", "output": f"Tool '{tool_name}' not found"})})
-                        continue
+                        observation = {"step": "observe", "outputs": [
+                            {"function": call.get("function"), "output": output} for call, output in zip(calls, outputs)
+                        ]}
+                    messages.append({"role":"assistant","content": orjson.dumps(observation).decode()})
+                    continue
                         
-                if parsed_response.get("step") == "output":
-                    print(f"📚: {parsed_response.get('content')}")
+                if step == "output":
+                    if not printed:
+                        print(f"📚: {parsed_response.get('content')}")
+                    for index in reversed(plan_steps):
+                        del messages[index]
                     break
                     
             except Exception as e:
                 print(f"An error occurred: {e}")
                 break
 
+        # Between turns, so the summary call never delays an answer
+        if len(messages) > MAX_MESSAGES:
+            compacted = history_pool.submit(compact_history, list(messages))
+
+    history_pool.shutdown(wait=False)
+    tool_pool.shutdown(wait=False)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file